@@ -33,8 +33,11 @@ tidy-rpm-cache.py {-d|--dir=dir}
                   {-f|--force}
                   {--ignore-arch}
                   {--ignore-file-errors}
+                  {-j|--jobs=number}
                   {--log-prefix=text}
+                  {--no-header-cache}
                   {-s|--srpm}
+                  {--trust-filenames}
                   {-u|--usage} {-h|--help} {--version}
                   {-v|--verbose} {-q|--quiet}
 
@@ -117,11 +120,19 @@ Options:
                          regardless of whether their architectures differ
 
     --ignore-file-errors Do not print errors relating to reading RPM package
-                         files
+                         files. The files of packages which have no obsolete
+                         versions are then not read at all.
+
+-j, --jobs     =<int>    The number of RPM headers to read at the same time.
+                         The default value is the number of CPUs.
 
     --log-prefix =<text> Prepend text to the start of every information,
                          warning, and error message.
 
+    --no-header-cache    Do not read or update the RPM headers cached between
+                         runs in $XDG_CACHE_HOME/tidy-rpm-cache
+                         (~/.cache/tidy-rpm-cache by default).
+
 -n, --num-obsolete=<int> The maximum number of obsolete versions of a
                          package to keep. Note that the default value is 0
                          meaning that all but the newest version of a
@@ -133,6 +144,12 @@ Options:
 -s, --srpm               Check for obsolete source RPMs instead of normal
                          RPMs.
 
+    --trust-filenames    Compare package versions using the filenames of RPM
+                         files which follow the name-version-release.arch.rpm
+                         template, without reading their headers. This is
+                         faster, but package epochs are not taken into
+                         account.
+
 -u, --usage              Display usage information
 
 -v, --verbose            Increase the amount of information displayed
@@ -151,11 +168,11 @@ The following outlines the basic control flow in this script.
         | create RunData object to contain obsolete paths and other stats
         | parse command line arguments
         |-> find_rpms() in all search directories
-        | Create an RPM transaction set
         |-> find_obsolete_rpms()
-            | read RPM header data from file
+            | read RPM header data from files in a thread pool
             |-> cmp_RpmData_by_version
-                |-> rpm.versionCompare()
+                |-> compare_evr() (cached)
+                    |-> rpm.labelCompare()
             | if more than num_obsolete versions exist for a package:
                 |-> display_pkg_summary()
                 | add obsolete RPM paths to RunData
@@ -176,21 +193,63 @@ __version__         = "Version: 1500".split( ' ' )[ 1 ]
 
 import sys
 import os
-from os.path import basename
 import logging
-import getopt
+import argparse
 import traceback
 from time import gmtime, strftime
 import re
-from functools import cmp_to_key
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import json
+import tempfile
+from functools import cmp_to_key, lru_cache
+from collections import Counter
+from heapq import nlargest
+from operator import attrgetter
 import rpm
 
-# The global information, warning, and error message target.
-g_logger            = None
+# The global information, warning, and error message target. Its handler is
+# set up by tidy_rpm_cache.
+g_logger            = logging.getLogger()
 # Flag indicating if package architectures should be ignored.
 g_ignore_arch       = False
+# Flag indicating if package versions should be read from filenames instead
+# of RPM headers.
+g_trust_filenames   = False
+# Flag indicating RPM headers should be validated.
+g_verify_headers    = False
+# The number of threads reading RPM headers.
+g_num_jobs          = os.cpu_count() or 1
 # Flag indicating if the header of the results has already been displayed.
 g_display_header    = True
+# The RPM transaction set of each header reading thread.
+g_thread_data       = threading.local()
+
+# The number of RPM files whose headers are prefetched together.
+HEADER_BATCH_SIZE   = 256
+# The number of bytes at the start of an RPM file to prefetch. This is enough
+# to cover the lead, signature, and header of most packages.
+HEADER_PREFETCH_SIZE = 16384
+# The file in which RPM headers are cached between runs.
+HEADER_CACHE_PATH   = os.path.join( os.environ.get( 'XDG_CACHE_HOME' )
+                                    or os.path.join( os.path.expanduser( '~' )
+                                                     , '.cache' )
+                                    , 'tidy-rpm-cache', 'headers.json' )
+# The header tags used by the script, which are kept in the header cache.
+HEADER_TAGS         = ( 'name', 'epoch', 'version', 'release', 'arch'
+                        , 'buildtime' )
+
+# The width of the package information summary table.
+PKG_INFO_MAX_WIDTH  = 70
+# The widths of the version, build date, size, and action columns.
+PKG_INFO_WIDTHS     = ( 34, 11, 7, 8 )
+assert sum( PKG_INFO_WIDTHS ) < PKG_INFO_MAX_WIDTH
+# The format of a row in the package information summary table.
+PKG_INFO_FORMAT     = "    %%%ds %%%ds %%%d.2fM  %%%ds" % PKG_INFO_WIDTHS
+# Appended to versions too long for their column, so that the rest of the row
+# continues on a new line below the column. LogFormatter repeats the log
+# prefix text on the new line.
+PKG_INFO_VERSION_WRAP = "\n" + " " * ( PKG_INFO_WIDTHS[ 0 ] + 4 )
 
 
 class RpmData:
@@ -200,15 +259,21 @@ class RpmData:
     header -- The RPM header.
     path -- The path of the RPM file (string).
     size -- The size of the RPM file.
+    evr -- The (epoch, version, release) of the package, as returned by
+    evr_from_header.
     """
 
+    __slots__ = ( 'header', 'path', 'size', 'evr' )
+
     def __init__( self
                   , header
-                  , path ):
+                  , path
+                  , size ):
         """ Constructor for RpmData instances. """
         self.header = header
         self.path = path
-        self.size = -1
+        self.size = size
+        self.evr = evr_from_header( header )
 
 
 class RunData:
@@ -233,69 +298,354 @@ class RunData:
         self.total_obs_size = 0
 
 
+class HeaderCache:
+    """ Keeps the package information read from the headers of RPM files
+    between runs of the script, so that unchanged files do not have to be read
+    and parsed again.
+
+    Members:
+    path -- The path of the cache file (string).
+    entries -- The cached package information, indexed by the absolute path
+    of the RPM file, so the entries are shared by all runs whichever
+    directories they search and however the paths are given. Each value is a list of the file inode number, modification time (in
+    nanoseconds) and size, followed by the list of the values of HEADER_TAGS,
+    or by the error message if the file is not a valid RPM file.
+    modified -- Flag indicating entries were added during this run.
+
+    The cache is stored as JSON, so loading it cannot run code even if the
+    file was written by another user.
+    """
+
+    def __init__( self, path ):
+        """ Constructor for HeaderCache instances. """
+        self.path = path
+        self.entries = {}
+        self.modified = False
+        # The absolute path and (inode, modification time, size) of files
+        # looked up but not found, indexed by the path given to get.
+        self.file_keys = {}
+
+    def load( self ):
+        """ Reads the cache file. A missing or unreadable cache file leaves
+        the cache empty.
+
+        Returns nothing.
+        """
+        global g_logger
+
+        try:
+            with open( self.path, 'r', encoding = 'utf-8' ) as cache_file:
+                entries = json.load( cache_file )
+        except FileNotFoundError:
+            return
+        except ( os.error, ValueError ) as e:
+            g_logger.debug( "Ignoring header cache '%s': %s", self.path, e )
+            return
+
+        if isinstance( entries, dict ):
+            self.entries = entries
+
+    def save( self, search_dir_paths, rpm_paths ):
+        """ Writes the cache file. The file is only written if entries were
+        added or removed during this run.
+
+        Keyword arguments:
+        search_dir_paths -- The directories searched during this run.
+        rpm_paths -- The paths of all the RPM files found during this run.
+
+        The entries of files under the searched directories which were not
+        found and no longer exist are dropped. The entries of other files,
+        such as those searched by other runs or excluded from this one, are
+        kept.
+
+        Returns nothing.
+        """
+        global g_logger
+
+        found_paths = set( os.path.abspath( rpm_path )
+                           for rpm_path in rpm_paths )
+        dir_prefixes = tuple( os.path.join( os.path.abspath( dir_path ), '' )
+                              for dir_path in search_dir_paths )
+        entries = { rpm_path: cached
+                    for rpm_path, cached in self.entries.items()
+                    if rpm_path in found_paths
+                       or not rpm_path.startswith( dir_prefixes )
+                       or os.path.lexists( rpm_path ) }
+        if not self.modified and len( entries ) == len( self.entries ):
+            return
+
+        # Each run writes its own temporary file, so concurrent runs do not
+        # write to the same file.
+        tmp_path = None
+        try:
+            cache_dir = os.path.dirname( self.path )
+            os.makedirs( cache_dir, exist_ok = True )
+            tmp_fd, tmp_path = tempfile.mkstemp( dir = cache_dir
+                                                 , suffix = ".tmp" )
+            with open( tmp_fd, 'w', encoding = 'utf-8' ) as cache_file:
+                json.dump( entries, cache_file, separators = ( ',', ':' ) )
+            os.replace( tmp_path, self.path )
+        except ( os.error, TypeError, ValueError ) as e:
+            g_logger.warning( "Unable to write header cache '%s': %s"
+                              , self.path, e )
+            if tmp_path is not None and os.path.lexists( tmp_path ):
+                os.remove( tmp_path )
+
+    def get( self, rpm_entry ):
+        """ Looks up the package information of an RPM file.
+
+        Keyword arguments:
+        rpm_entry -- The os.DirEntry of the RPM file. Its cached stat result
+        is used, and is reused later for the file size.
+
+        Returns the cached package information, as returned by
+        header_from_values, the cached error message (a string) if the file
+        was found to be invalid by a previous run, or None if the file is not
+        cached or has changed since it was cached.
+        """
+        try:
+            rpm_stat = rpm_entry.stat( follow_symlinks = False )
+        except os.error:
+            return None
+
+        cache_path = os.path.abspath( rpm_entry.path )
+        file_key = [ rpm_stat.st_ino, rpm_stat.st_mtime_ns, rpm_stat.st_size ]
+        cached = self.entries.get( cache_path )
+        if isinstance( cached, list ) and len( cached ) == 4 \
+           and cached[ 0:3 ] == file_key:
+            if isinstance( cached[ 3 ], str ):
+                return cached[ 3 ]
+            if isinstance( cached[ 3 ], list ) \
+               and len( cached[ 3 ] ) == len( HEADER_TAGS ):
+                return header_from_values( cached[ 3 ] )
+
+        self.file_keys[ rpm_entry.path ] = ( cache_path, file_key )
+        return None
+
+    def put( self, rpm_path, rpm_hdr ):
+        """ Adds the package information of an RPM file which was looked up
+        with get.
+
+        Keyword arguments:
+        rpm_path -- The path of the RPM file.
+        rpm_hdr -- The RPM header read from the file.
+
+        Returns nothing.
+        """
+        cache_path, file_key = self.file_keys.pop( rpm_path, ( None, None ) )
+        if file_key is not None:
+            self.entries[ cache_path ] = file_key + [
+                [ rpm_hdr[ tag ] for tag in HEADER_TAGS ] ]
+            self.modified = True
+
+    def put_error( self, rpm_path, file_error ):
+        """ Records that an RPM file which was looked up with get is not a
+        valid RPM file, so that it is not read again until it changes.
+
+        Keyword arguments:
+        rpm_path -- The path of the RPM file.
+        file_error -- The error message reported for the file.
+
+        Returns nothing.
+        """
+        cache_path, file_key = self.file_keys.pop( rpm_path, ( None, None ) )
+        if file_key is not None:
+            self.entries[ cache_path ] = file_key + [ file_error ]
+            self.modified = True
+
+
+class OptionParser( argparse.ArgumentParser ):
+    """ Parses the command-line options of the script. Errors are reported
+        like the other errors of the script instead of by argparse.
+    """
+
+    def error( self, message ):
+        """ Logs an option error, displays the usage information, and exits.
+
+        Keyword arguments:
+        message -- The error message.
+
+        Returns nothing.
+        """
+        global g_logger
+
+        g_logger.error( "%s", message )
+        display_usage()
+        sys.exit( 2 )
+
+
+class LogFormatter( logging.Formatter ):
+    """ Formats log messages, repeating the prefix text and level name at the
+        start of every line of messages which span several lines. This lets
+        related lines be logged together as one message.
+
+    Members:
+    prefix -- The text to print at the start of each line (string).
+    """
+
+    def __init__( self, prefix = "" ):
+        """ Constructor for LogFormatter instances. """
+        logging.Formatter.__init__( self )
+        self.prefix = prefix
+
+    def format( self, record ):
+        """ Formats a log record.
+
+        Keyword arguments:
+        record -- The logging.LogRecord to format.
+
+        Returns the formatted message.
+        """
+        line_prefix = self.prefix + "[" + record.levelname + "] "
+        return line_prefix + logging.Formatter.format( self, record ).replace(
+            "\n", "\n" + line_prefix )
+
+
+# The parser of the command-line options, built once when the module is
+# loaded. The help, usage, and version information is displayed by the script
+# itself.
+OPTION_PARSER = OptionParser( add_help = False )
+# The actions of the options, as returned by add_argument.
+OPTION_ACTIONS = [
+    OPTION_PARSER.add_argument( '-d', '--dir', action = 'append'
+                                , default = None )
+    , OPTION_PARSER.add_argument( '-x', '--exclude', action = 'append'
+                                  , default = None )
+    , OPTION_PARSER.add_argument( '-f', '--force', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '-h', '--help', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '--ignore-arch', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '-i', '--ignore-file-errors'
+                                  , action = 'store_true' )
+    , OPTION_PARSER.add_argument( '-j', '--jobs', type = int, default = None )
+    , OPTION_PARSER.add_argument( '--log-prefix', default = "" )
+    , OPTION_PARSER.add_argument( '--no-header-cache', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '-n', '--num-obsolete', type = int
+                                  , default = 0 )
+    , OPTION_PARSER.add_argument( '-q', '--quiet', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '-s', '--srpm', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '--trust-filenames', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '-u', '--usage', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '-v', '--verbose', action = 'count'
+                                  , default = 0 )
+    , OPTION_PARSER.add_argument( '--verify-headers', action = 'store_true' )
+    , OPTION_PARSER.add_argument( '--version', action = 'store_true' ) ]
+
+
+def long_option_string( option_action ):
+    """ Finds the long option string of an option.
+
+    Keyword arguments:
+    option_action -- The argparse action of the option.
+
+    Returns the option string starting with '--'.
+    """
+    return [ option_string for option_string in option_action.option_strings
+             if option_string.startswith( '--' ) ][ 0 ]
+
+
+# The long option string of each option which takes a value, indexed by each
+# of the option's strings.
+OPTION_VALUE_FORMS = { option_string: long_option_string( option_action )
+                       for option_action in OPTION_ACTIONS
+                       if option_action.nargs != 0
+                       for option_string in option_action.option_strings }
+
+
+def join_option_values( argV ):
+    """ Joins the options which take a value to the value given in the
+        following argument, in their long form, e.g. '-x' '-debug' becomes
+        '--exclude=-debug'. argparse rejects separate values which start with
+        '-', but getopt accepted them, and existing command lines rely on
+        this. The long form also keeps empty values.
+
+    Keyword arguments:
+    argV -- The list of command-line arguments.
+
+    Returns the new list of command-line arguments.
+    """
+    joined_args = []
+    i = 0
+    while i < len( argV ):
+        arg = argV[ i ]
+        if arg == '--':
+            joined_args.extend( argV[ i: ] )
+            break
+
+        if arg in OPTION_VALUE_FORMS and i + 1 < len( argV ):
+            joined_args.append( OPTION_VALUE_FORMS[ arg ] + '='
+                                + argV[ i + 1 ] )
+            i += 2
+        else:
+            joined_args.append( arg )
+            i += 1
+
+    return joined_args
+
+
 def cmp_RpmData_by_version( a, b ):
-    """ Wrapper function which passes the RPM headers in two RpmData objects
-        to the rpm.versionCompare function.
+    """ Wrapper function which passes the epoch, version, and release of the
+        RPM headers in two RpmData objects to the rpm.labelCompare function.
 
     Returns:
     1 -- if the first RPM file is a newer version than the second.
     0 -- if both RPM files provide the same version of the package.
     -1 -- if the first RPM file is an older version than the second.
     """
-    return rpm.versionCompare( a.header, b.header )
+    return compare_evr( a.evr, b.evr )
 
 
-def cmp(a, b):
-    return (a > b) - (a < b)
+@lru_cache( maxsize = 4096 )
+def compare_evr( a_evr, b_evr ):
+    """ Compares two (epoch, version, release) tuples with rpm.labelCompare.
 
-def cmp_paths_by_filename( a, b ):
-    """ Compares paths based on the filename part only.
+    The results are cached, since files with the same versions, such as the
+    builds of a package for several architectures, are compared repeatedly.
 
-    Returns:
-    1 -- if the filename in the first path is greater than the second.
-    0 -- if the filename in the first path is equal to the second.
-    -1 -- if the filename in the first path is less than the second.
+    Returns the result of rpm.labelCompare.
     """
-    return cmp( basename( a ), basename( b ) )
+    return rpm.labelCompare( a_evr, b_evr )
 
 
-def cmp_paths_by_pkg_name_and_arch( a, b ):
-    """ Compares paths based on the name and architecture of the package.
+def evr_from_header( header ):
+    """ Extracts the version information from an RPM header, or from the
+        package information generated by headers_from_filenames.
 
-    Returns:
-    1 -- if the filename in the first path is greater than the second.
-    0 -- if the filename in the first path is equal to the second.
-    -1 -- if the filename in the first path is less than the second.
+    Returns an (epoch, version, release) tuple of strings, as expected by
+    rpm.labelCompare. The epoch is None if the package does not have one.
+    """
+    epoch = header[ 'epoch' ]
+    if epoch is not None:
+        epoch = str( epoch )
+    return ( epoch, header[ 'version' ], header[ 'release' ] )
+
+
+def key_entry_by_pkg_name_and_arch( entry ):
+    """ Generates a sort key for a directory entry based on the name and
+        architecture of the package.
+
+    Returns a tuple of the architecture and the package name.
 
     The code works best with RPM packages which adhere to the following
     filename template:
-        [PACKAGE_NAME]-[MAJOR].[MINOR]-[REVISION].[OS].[ARCH].rpm
+        [PACKAGE_NAME]-[VERSION]-[RELEASE].[ARCH].rpm
 
-    This is the template used for most Fedora packages. If the filename is
-    structured differently, the cmp_paths_by_filename function is used.
+    This is the template used for most Fedora and Mageia packages. If the
+    filename is structured differently, the part before the '.rpm' extension
+    is used as the architecture and the whole filename as the package name.
     Developers may wish to redesign this function or add there own to suit other
     filename template.
     """
+    file_name = entry.name
+    nevra = parse_nevra( file_name )
 
-    result = 0
-    a_parts = basename( a ).split( '.' )
-    b_parts = basename( b ).split( '.' )
-
-    if len( a_parts ) > 2 and len( b_parts ) > 2:
-        # Compare the architecture part.
-        result = cmp( a_parts[ len( a_parts ) - 2 ]
-                    , b_parts[ len( b_parts ) - 2 ] )
-        if result == 0:
-            # Compare the parts containing the package and the version data.
-            if len( a_parts ) > 3 and len( b_parts ) > 3:
-                result = cmp( a_parts[ 0:( len( a_parts ) - 3 ) ]
-                              , b_parts[ 0:( len( b_parts ) - 3 ) ] )
-            else:
-                cmp_paths_by_filename( a, b )
-    else:
-        result = cmp_paths_by_filename( a, b )
+    if nevra is not None:
+        return ( nevra[ 4 ], nevra[ 0 ] )
 
-    return result
+    parts = file_name.split( '.' )
+    if len( parts ) > 2:
+        return ( parts[ -2 ], file_name )
+    else:
+        return ( file_name, file_name )
 
 
 def tidy_rpm_cache( argV ):
@@ -312,112 +662,79 @@ def tidy_rpm_cache( argV ):
     """
     global g_logger
     global g_ignore_arch
+    global g_trust_filenames
+    global g_verify_headers
+    global g_num_jobs
 
 
     # Create container object for obsolete paths and other statistics.
     run_data            = RunData()
-    # The directory in which to search for RPMs.
-    search_dir_paths    = []
-    # Number of obsolete versions of a package to allow.
-    num_obsolete        = 0
-    # The packages which are excluded.
-    excluded            = []
-    # Flag indicating that script should search for obsolete SRPMS.
-    srpm_mode           = False
-    # Flag indicating that user should not have to confirm deletion.
-    force_del           = False
-    # Flag indicating RPM headers should be validated.
-    verify_headers      = False
-    # Flag indicating that errors relating reading files should be ignored.
-    ignore_file_errors  = False
-    # The verbosity of information messages.
-    logging_level       = logging.INFO
-    # The text to print at the start of each information, warning, and error
-    # message.
-    log_prefix          = ""
 
     # Set up basic logging.
-    g_logger = logging.getLogger()
     log_stream = logging.StreamHandler()
-    log_stream.setFormatter(
-        logging.Formatter( '[%(levelname)s] %(message)s' ) )
+    log_stream.setFormatter( LogFormatter() )
     g_logger.addHandler( log_stream )
-    g_logger.setLevel( logging_level )
-
-    # Parse command-line arguments.
-    try:
-        opts, args = getopt.getopt( argV
-                                    , 'd:fhin:qsuvx:'
-                                    , [ 'dir='
-                                        , 'exclude='
-                                        , 'force'
-                                        , 'help'
-                                        , 'ignore-file-errors'
-                                        , 'ignore-arch'
-                                        , 'log-prefix='
-                                        , 'num-obsolete='
-                                        , 'quiet'
-                                        , 'srpm'
-                                        , 'usage'
-                                        , 'verbose'
-                                        , 'verify-headers'
-                                        , 'version' ] )
-    except getopt.GetoptError as e:
-        g_logger.error( str( e ) )
-        display_usage()
-        sys.exit( 2 )
-
-    # Store command-line argument values.
-    for opt, arg in opts:
-        if opt in ( '-d', '--dir' ):
-            search_dir_paths.append( arg )
-
-        if opt in ( '-x', '--exclude' ):
-            excluded.append( arg )
-
-        if opt in ( '-f', '--force' ):
-            force_del = True
+    g_logger.setLevel( logging.INFO )
 
-        if opt in ( '', '--log-prefix' ):
-            log_prefix = arg
+    # Parse command-line arguments. Invalid options are reported by
+    # OptionParser.error, which exits.
+    opts = OPTION_PARSER.parse_args( join_option_values( argV ) )
 
-        if opt in ( '-h', '--help' ):
-            display_help()
-            sys.exit()
+    if opts.help:
+        display_help()
+        sys.exit()
 
-        if opt in ( '-n', '--num-obsolete' ):
-            try:
-                num_obsolete = int( arg )
-            except ValueError:
-                g_logger.error( "Invalid num-obsoletes value '%s'", arg )
-                display_usage()
-                sys.exit( 1 )
-
-        if opt in ( '-i', '--ignore-file-errors' ):
-            ignore_file_errors = True
+    if opts.usage:
+        display_usage()
+        sys.exit()
 
-        if opt in ( '', '--ignore-arch' ):
-            g_ignore_arch = True
+    if opts.version:
+        display_version()
+        sys.exit()
 
-        if opt in ( '-q', '--quiet' ):
-            logging_level = logging.WARNING
+    # The directories in which to search for RPMs.
+    search_dir_paths    = opts.dir
+    # Number of obsolete versions of a package to allow.
+    num_obsolete        = opts.num_obsolete
+    # The compiled regular expressions matching excluded packages.
+    excluded            = []
+    # Flag indicating that script should search for obsolete SRPMS.
+    srpm_mode           = opts.srpm
+    # Flag indicating that user should not have to confirm deletion.
+    force_del           = opts.force
+    # Flag indicating that errors relating reading files should be ignored.
+    ignore_file_errors  = opts.ignore_file_errors
+    # Flag indicating RPM headers should be cached between runs.
+    use_header_cache    = not opts.no_header_cache
+    # The verbosity of information messages.
+    if opts.quiet:
+        logging_level = logging.WARNING
+    else:
+        logging_level = logging.INFO
+    logging_level -= 10 * opts.verbose
+    # The text to print at the start of each information, warning, and error
+    # message.
+    log_prefix          = opts.log_prefix
 
-        if opt in ( '-s', '--srpm' ):
-            srpm_mode = True
+    g_ignore_arch       = opts.ignore_arch
+    g_trust_filenames   = opts.trust_filenames
+    g_verify_headers    = opts.verify_headers
 
-        if opt in ( '-u', '--usage' ):
+    if opts.jobs is not None:
+        if opts.jobs < 1:
+            g_logger.error( "Invalid jobs value '%d'", opts.jobs )
             display_usage()
-            sys.exit()
-
-        if opt in ( '-v', '--verbose' ):
-            logging_level -= 10
+            sys.exit( 1 )
+        g_num_jobs = opts.jobs
 
-        if opt in ( '', '--verify-headers' ):
-            verify_headers = True
-
-        if opt in ( '', '--version' ):
-            display_version()
-            sys.exit()
+    for pattern in opts.exclude or []:
+        try:
+            excluded.append( re.compile( pattern ) )
+        except re.error as e:
+            g_logger.error( "The expression '%s' could not be compiled: %s"
+                            , pattern, str( e ) )
+            display_usage()
+            sys.exit( 1 )
 
     # Adjust logging configuration using new option values.
     if logging_level > logging.DEBUG:
@@ -425,63 +742,84 @@ def tidy_rpm_cache( argV ):
     else:
         g_logger.setLevel( logging.DEBUG )
     if len( log_prefix ) > 0:
-        log_stream.setFormatter(
-            logging.Formatter( log_prefix + "[%(levelname)s] %(message)s" ) )
+        log_stream.setFormatter( LogFormatter( log_prefix ) )
 
     if g_logger.getEffectiveLevel() <= logging.INFO:
         display_version()
         display_disclaimer()
 
     # If no search directories were specified, use the current directory.
-    if len( search_dir_paths ) == 0:
-        search_dir_paths.append( '.' )
+    if search_dir_paths is None:
+        search_dir_paths = [ '.' ]
 
     if num_obsolete < 0:
-        g_logger.warn( "Number of obsoletes cannot be negative, setting to 0" )
+        g_logger.warning( "Number of obsoletes cannot be negative, setting to "
+                          "0" )
         num_obsolete = 0
 
-    # Check and compile all regular expressions for excluded package names.
-    reg_ex_objects = []
-    for reg_ex in excluded:
+    # Drop repeated expressions, keeping the order they were given in.
+    excluded = list( dict.fromkeys( excluded ) )
+
+    # Fuse the expressions into a single alternation so that each filename is
+    # tested with one search instead of one per expression. Back-references
+    # would be renumbered by the fusion, so such expressions are kept apart.
+    if len( excluded ) > 1 and \
+            not any( re.search( r'\\[1-9]|\(\?P=', pattern.pattern )
+                     for pattern in excluded ):
         try:
-            pattern = re.compile( reg_ex )
-            reg_ex_objects.append( pattern )
-        except re.error as e:
-            g_logger.warning( "The expression '%s' could not be compiled: %s", reg_ex, str( e ) )
+            excluded = [ re.compile(
+                "|".join( "(?:" + pattern.pattern + ")"
+                          for pattern in excluded ) ) ]
+        except re.error:
+            # Global flags and duplicate group names are not allowed inside
+            # an alternation, so match the expressions separately.
+            pass
 
     # Generate a list of all RPM paths in the search directories.
-    rpm_paths = find_rpms( search_dir_paths
-                           , reg_ex_objects
+    rpm_entries = find_rpms( search_dir_paths
+                           , excluded
                            , srpm_mode )
-    run_data.total_found = len( rpm_paths )
+    run_data.total_found = len( rpm_entries )
     if run_data.total_found > 0:
         g_logger.debug( "Found %d RPM files.", run_data.total_found )
     else:
         g_logger.info( "No RPM files were found." )
         return
 
-    # Create an RPM transaction set.
-    rpm_trans_set = rpm.TransactionSet()
-    if not verify_headers:
-        rpm_trans_set.setVSFlags( rpm.RPMVSF_NODSA | rpm.RPMVSF_NODSAHEADER )
+    # Package filenames are not signed, so always read the headers when they
+    # have to be verified.
+    if g_verify_headers:
+        g_trust_filenames = False
 
-    # Sort the list of RPM paths by filename.
+    # Sort the list of RPM files by filename.
     if g_ignore_arch:
-        rpm_paths.sort( key = cmp_to_key(cmp_paths_by_filename) )
+        rpm_entries.sort( key = attrgetter( 'name' ) )
     else:
-        rpm_paths.sort( key = cmp_to_key(cmp_paths_by_pkg_name_and_arch) )
+        rpm_entries.sort( key = key_entry_by_pkg_name_and_arch )
+
+    # Load the package information cached by previous runs. Cached files are
+    # not verified again, so the cache is not used when verifying headers.
+    header_cache = None
+    if use_header_cache and not g_verify_headers:
+        header_cache = HeaderCache( HEADER_CACHE_PATH )
+        header_cache.load()
 
     # Identify the obsolete files and add them to run_data.obs_paths.
-    find_obsolete_rpms( rpm_paths
+    find_obsolete_rpms( rpm_entries
                         , run_data
-                        , rpm_trans_set
-                        , num_obsolete )
+                        , num_obsolete
+                        , header_cache
+                        , not ignore_file_errors )
+
+    if header_cache is not None:
+        header_cache.save( search_dir_paths
+                           , [ entry.path for entry in rpm_entries ] )
 
     if not ignore_file_errors and len( run_data.file_errors ) > 0:
-        g_logger.warn( "%d file errors occurred. These are listed below.",
-                        len( run_data.file_errors ) )
-        for file_error in run_data.file_errors:
-            g_logger.warn( file_error )
+        g_logger.warning( "%d file errors occurred. These are listed below."
+                          "\n%s"
+                          , len( run_data.file_errors )
+                          , "\n".join( run_data.file_errors ) )
 
     # Ask for user confirmation before deleting.
     if len( run_data.obs_paths ) > 0:
@@ -501,98 +839,158 @@ def find_rpms( search_dir_paths
     excluded -- A list of regular expressions to exclude from the results.
     srpm_mode -- Search for .src.rpm files instead of .rpm files.
 
-    Returns a list of paths to RPM files.
+    Returns a list of os.DirEntry objects of RPM files. Their names and paths
+    are used directly, so no path has to be split or joined again.
     """
     global g_logger
     results = list()
+    # Checked once, so that the per-file debug messages cost nothing when
+    # they are not displayed.
+    debug_enabled = g_logger.isEnabledFor( logging.DEBUG )
 
     for dir_path in search_dir_paths:
         g_logger.debug( "Searching directory '%s'", dir_path )
-        for root, dirs, files in os.walk( dir_path ):
-            for file_name in files:
-                if not os.path.isfile( os.path.join(root, file_name ) ):
-                    continue
-
-                if os.path.islink( os.path.join(root, file_name ) ):
-                    continue
-
-                if file_name.endswith( ".rpm" ):
-                    if file_name.endswith( ".src.rpm" ):
-                        if not srpm_mode:
-                            continue
-                    elif srpm_mode:
-                        continue
-                else:
-                    continue
-
-                is_excluded = False
-                for reg_ex in excluded:
-                    if reg_ex.search( file_name ):
-                        is_excluded = True
-                        break
-                if is_excluded:
+        for entry in walk_rpm_dir( dir_path, srpm_mode ):
+            file_name = entry.name
+            is_excluded = False
+            for reg_ex in excluded:
+                if reg_ex.search( file_name ):
+                    is_excluded = True
+                    break
+            if is_excluded:
+                if debug_enabled:
                     g_logger.debug( "Excluding '%s'", file_name )
-                    continue
+                continue
 
+            if debug_enabled:
                 g_logger.debug( "Found '%s'", file_name )
-                results.append( os.path.join(root, file_name ) )
+            results.append( entry )
 
     return results
 
 
-def find_obsolete_rpms( rpm_paths
+def walk_rpm_dir( dir_path, srpm_mode ):
+    """ Recursively lists the RPM package files in a directory.
+
+    Keyword arguments:
+    dir_path -- The path of the directory to search.
+    srpm_mode -- List .src.rpm files instead of .rpm files.
+
+    The filename of each entry is checked first, so the metadata files which
+    make up most of a YUM cache are rejected by a string test alone. The
+    directory entries returned by os.scandir carry the file type, so symbolic
+    links and non-regular files are skipped without a stat call for each
+    file. Directories are searched whatever their names, and directories
+    which cannot be read are ignored, as os.walk does.
+
+    Yields an os.DirEntry for each matching regular file.
+    """
+    try:
+        dir_iter = os.scandir( dir_path )
+    except os.error:
+        return
+
+    with dir_iter:
+        for entry in dir_iter:
+            file_name = entry.name
+            try:
+                if file_name.endswith( ".rpm" ) \
+                        and file_name.endswith( ".src.rpm" ) == srpm_mode \
+                        and entry.is_file( follow_symlinks = False ):
+                    yield entry
+                # Directories whose names end in '.rpm' are searched too.
+                elif entry.is_dir( follow_symlinks = False ):
+                    yield from walk_rpm_dir( entry.path, srpm_mode )
+            except os.error:
+                continue
+
+
+def find_obsolete_rpms( rpm_entries
                         , run_data
-                        , rpm_trans_set
-                        , num_obsolete ):
+                        , num_obsolete
+                        , header_cache
+                        , check_skipped ):
     """ Identifies the obsolete files in a list of RPM package files.
 
     Keyword arguments:
-    rpm_paths -- A sorted list of RPM pacakge file paths.
+    rpm_entries -- A sorted list of os.DirEntry objects of RPM package files.
     run_data -- A RunData object in which to store the obsolete paths.
-    rpm_trans_set -- A valid RPM transaction set.
     num_obsolete -- The maximum number of obsolete versions allowed for each
     package.
+    header_cache -- A HeaderCache object, or None to always read the headers
+    from the RPM files.
+    check_skipped -- Flag indicating the files of packages which cannot have
+    obsolete versions should still be read, so that invalid files are
+    reported.
 
     Returns nothing.
 
     """
     global g_logger
     global g_ignore_arch
-
-    last_package_tag = ''
+    global g_trust_filenames
+
+    # Count the files of each package using their filenames, and drop the
+    # packages which cannot have obsolete versions before their headers are
+    # read. Files whose names do not follow the usual template are kept.
+    file_tags = [ pkg_tag_from_filename( entry.name )
+                  for entry in rpm_entries ]
+    tag_counts = Counter( file_tags )
+    skipped_entries = []
+    group_entries = []
+    for entry, file_tag in zip( rpm_entries, file_tags ):
+        if file_tag is None or tag_counts[ file_tag ] > ( num_obsolete + 1 ):
+            group_entries.append( entry )
+        else:
+            skipped_entries.append( entry )
+    rpm_entries = group_entries
+
+    # The headers of the skipped files are not needed, but reading them
+    # reports truncated or corrupt downloads. Unchanged files are found in
+    # the header cache without being read again.
+    if check_skipped and not g_trust_filenames and skipped_entries:
+        g_logger.debug( "Checking the headers of %d RPM files."
+                        , len( skipped_entries ) )
+        for entry, rpm_hdr in read_headers( skipped_entries
+                                            , run_data
+                                            , header_cache ):
+            pass
+
+    g_logger.debug( "Reading the headers of %d RPM files.", len( rpm_entries ) )
+
+    last_package_tag = None
     rpm_data_list = []
 
-    for path in rpm_paths:
-        # Read the header from the RPM file.
-        rpm_hdr = None
+    if g_trust_filenames:
+        get_headers = headers_from_filenames
+    else:
+        get_headers = read_headers
+
+    if g_ignore_arch:
+        get_pkg_tag = pkg_tag_by_name
+    else:
+        get_pkg_tag = pkg_tag_by_name_and_arch
+
+    for entry, rpm_hdr in get_headers( rpm_entries
+                                       , run_data
+                                       , header_cache ):
+        # The size is taken from the directory entry, which caches it.
         try:
-            rpm_fd = os.open( path, os.O_RDONLY )
-            rpm_hdr = rpm_trans_set.hdrFromFdno( rpm_fd )
-            os.close( rpm_fd )
+            rpm_size = entry.stat( follow_symlinks = False ).st_size
         except os.error as e:
             run_data.file_errors.append(
-                "Unable to open file: '" + path + "'\nReason: " + str( e ) )
-        except rpm.error as e:
-            run_data.file_errors.append(
-                "Unable to read RPM file: '" + path + "'\nReason: " + str( e ) )
-
-        if rpm_hdr is None:
+                "Unable to open file: '%s'\nReason: %s" % ( entry.path, e ) )
             continue
 
         # If the current RPM package name differs to the previous one, then we
         # can assume we have processed all RPM files which provide the previous
         # package.
-        # g_logger.debug( "Package '%s'" % ( rpm_hdr[ 'name' ] ) );
-        current_rpm_tag = rpm_hdr[ 'name' ]
-        if not g_ignore_arch:
-            current_rpm_tag += rpm_hdr[ 'arch' ]
-
-        if current_rpm_tag != last_package_tag and last_package_tag != '':
-            if len( rpm_data_list ) > 0:
-                process_rpm_group( rpm_data_list, run_data, num_obsolete )
-            elif last_package_tag != '':
-                g_logger.debug( "Package '%s': %d total, 0 obsolete",
-                    ( last_package_tag, list_length ) )
+        # g_logger.debug( "Package '%s'", rpm_hdr[ 'name' ] )
+        current_rpm_tag = get_pkg_tag( rpm_hdr )
+
+        if current_rpm_tag != last_package_tag \
+           and last_package_tag is not None:
+            process_rpm_group( rpm_data_list, run_data, num_obsolete )
 
             # Delete all the data about the old package since we will not need
             # it again.
@@ -600,17 +998,312 @@ def find_obsolete_rpms( rpm_paths
 
         # Add the current package data to the list and remember its package
         # name.
-        rpm_data_list.append( RpmData( rpm_hdr, path ) )
+        rpm_data_list.append( RpmData( rpm_hdr, entry.path, rpm_size ) )
         last_package_tag = current_rpm_tag
 
-    # End of 'for path in rpm_paths'.
+    # End of 'for entry, rpm_hdr in get_headers( ... )'.
 
     # Process any remaining rpms in rpm_data_list.
     if len( rpm_data_list ) > 0:
         process_rpm_group( rpm_data_list, run_data, num_obsolete )
-    elif last_package_tag != '':
-        g_logger.debug( "Package '%s': %d total, 0 obsolete",
-                        last_package_tag, list_length )
+
+
+def pkg_tag_by_name( rpm_hdr ):
+    """ Generates the tag which groups the files of a package when
+        architectures are ignored.
+
+    Returns the interned package name, so comparing equal tags only compares
+    references.
+    """
+    return sys.intern( rpm_hdr[ 'name' ] )
+
+
+def pkg_tag_by_name_and_arch( rpm_hdr ):
+    """ Generates the tag which groups the files of a package built for one
+        architecture.
+
+    Returns a tuple of the interned package name and architecture.
+    """
+    return ( sys.intern( rpm_hdr[ 'name' ] ), sys.intern( rpm_hdr[ 'arch' ] ) )
+
+
+@lru_cache( maxsize = None )
+def parse_nevra( file_name ):
+    """ Extracts the package name, version, release, and architecture from an
+        RPM filename.
+
+    Keyword arguments:
+    file_name -- The filename of an RPM package file.
+
+    The filename is expected to follow the template:
+        [PACKAGE_NAME]-[VERSION]-[RELEASE].[ARCH].rpm
+
+    Package filenames do not contain the epoch, so it is always None. The
+    name and architecture are interned, since they are shared by many files.
+    The results are cached, since each filename is parsed for sorting, for
+    counting the files of each package, and again with --trust-filenames.
+
+    Returns a (name, epoch, version, release, arch) tuple, or None if the
+    filename does not follow the template.
+    """
+    nvr, sep, arch = file_name[ :-len( ".rpm" ) ].rpartition( '.' )
+    nvr_parts = nvr.rsplit( '-', 2 )
+    if not sep or not arch or len( nvr_parts ) < 3 or not all( nvr_parts ):
+        return None
+
+    return ( sys.intern( nvr_parts[ 0 ] ), None, nvr_parts[ 1 ], nvr_parts[ 2 ]
+             , sys.intern( arch ) )
+
+
+def pkg_tag_from_filename( file_name ):
+    """ Extracts the package name and architecture from an RPM filename.
+
+    Keyword arguments:
+    file_name -- The filename of an RPM package file.
+
+    Returns a tuple of the package name and architecture, or only the package
+    name if architectures are ignored. Returns None if the filename does not
+    follow the template expected by parse_nevra.
+    """
+    global g_ignore_arch
+
+    nevra = parse_nevra( file_name )
+    if nevra is None:
+        return None
+
+    if g_ignore_arch:
+        return nevra[ 0 ]
+    return ( nevra[ 0 ], nevra[ 4 ] )
+
+
+def header_from_values( values ):
+    """ Generates package information which can stand in for an RPM header.
+
+    Keyword arguments:
+    values -- A sequence of the values of HEADER_TAGS.
+
+    Returns a dictionary of the values indexed by tag name.
+    """
+    return dict( zip( HEADER_TAGS, values ) )
+
+
+def headers_from_filenames( rpm_entries
+                            , run_data
+                            , header_cache ):
+    """ Generates the package information of a list of RPM package files from
+        their filenames.
+
+    Keyword arguments:
+    rpm_entries -- A list of os.DirEntry objects of RPM package files.
+    run_data -- A RunData object in which to store file errors.
+    header_cache -- A HeaderCache object, or None to always read the headers
+    from the RPM files.
+
+    The package information is generated by header_from_values, with the
+    epoch and build time unknown (None). The
+    headers of files whose names cannot be parsed are read with read_headers.
+
+    Yields an (os.DirEntry, header) tuple for each file whose name could be
+    parsed or whose header could be read, in the order of rpm_entries.
+    """
+    nevras = [ parse_nevra( entry.name ) for entry in rpm_entries ]
+    read_entries = [ entry for entry, nevra in zip( rpm_entries, nevras )
+                     if nevra is None ]
+    read_hdrs = { entry.path: rpm_hdr
+                  for entry, rpm_hdr in read_headers( read_entries
+                                                      , run_data
+                                                      , header_cache ) }
+
+    for entry, nevra in zip( rpm_entries, nevras ):
+        if nevra is None:
+            rpm_hdr = read_hdrs.get( entry.path )
+        else:
+            rpm_hdr = header_from_values( nevra + ( None, ) )
+        if rpm_hdr is not None:
+            yield entry, rpm_hdr
+
+
+def read_headers( rpm_entries
+                  , run_data
+                  , header_cache ):
+    """ Reads the RPM headers of a list of RPM package files.
+
+    Keyword arguments:
+    rpm_entries -- A list of os.DirEntry objects of RPM package files.
+    run_data -- A RunData object in which to store file errors.
+    header_cache -- A HeaderCache object, or None to always read the headers
+    from the RPM files.
+
+    The package information found in the cache stands in for the headers of
+    unchanged files, and files the cache records as invalid are reported
+    without being read again. The remaining files are opened in batches of
+    HEADER_BATCH_SIZE using prefetch_headers, their headers are read by a pool
+    of g_num_jobs threads, and added to the cache. librpm releases the GIL
+    while reading, so the reads overlap.
+
+    Yields an (os.DirEntry, header) tuple for each file whose header could be
+    read, in the order of rpm_entries. The header is an RPM header, or the
+    package information returned by header_from_values for cached files.
+    """
+    with ThreadPoolExecutor( max_workers = g_num_jobs ) as executor:
+        for batch_start in range( 0, len( rpm_entries ), HEADER_BATCH_SIZE ):
+            batch_entries = rpm_entries[ batch_start:( batch_start
+                                                       + HEADER_BATCH_SIZE ) ]
+            batch_paths = [ entry.path for entry in batch_entries ]
+
+            # Look up the headers of the batch in the cache first.
+            batch_headers = [ None ] * len( batch_paths )
+            if header_cache is not None:
+                for i, entry in enumerate( batch_entries ):
+                    rpm_hdr = header_cache.get( entry )
+                    if isinstance( rpm_hdr, str ):
+                        run_data.file_errors.append( rpm_hdr )
+                        rpm_hdr = False
+                    batch_headers[ i ] = rpm_hdr
+
+            # Read the headers of the files which were not cached.
+            read_paths = [ path for path, rpm_hdr in zip( batch_paths
+                                                          , batch_headers )
+                           if rpm_hdr is None ]
+            new_headers = {}
+            read_results = executor.map( read_header
+                                         , read_paths
+                                         , prefetch_headers( read_paths ) )
+            for path, ( rpm_hdr, file_error, invalid ) in zip( read_paths
+                                                               , read_results ):
+                if file_error is not None:
+                    run_data.file_errors.append( file_error )
+                    if invalid and header_cache is not None:
+                        header_cache.put_error( path, file_error )
+                if rpm_hdr is not None:
+                    new_headers[ path ] = rpm_hdr
+                    if header_cache is not None:
+                        header_cache.put( path, rpm_hdr )
+
+            for entry, rpm_hdr in zip( batch_entries, batch_headers ):
+                if rpm_hdr is None:
+                    rpm_hdr = new_headers.get( entry.path )
+                if rpm_hdr:
+                    yield entry, rpm_hdr
+
+
+def prefetch_headers( rpm_paths ):
+    """ Opens a batch of RPM files and asks the kernel to start reading their
+        headers in the background.
+
+    Keyword arguments:
+    rpm_paths -- A list of RPM package file paths.
+
+    Issuing the read-ahead hints for the whole batch before any header is
+    parsed lets the disk service the reads together, instead of stalling on
+    each file in turn. On platforms without posix_fadvise the files are only
+    opened.
+
+    Files are opened relative to a descriptor of their directory which is
+    shared by the whole batch, so the kernel does not have to resolve every
+    directory component of the path for each file.
+
+    Returns a list containing an open file descriptor, or the os.error raised
+    while opening the file, for each path.
+    """
+    results = []
+    # The open directory descriptors, indexed by directory path.
+    dir_fds = {}
+
+    try:
+        for path in rpm_paths:
+            try:
+                if os.open in os.supports_dir_fd:
+                    dir_path, file_name = os.path.split( path )
+                    rpm_fd = os.open( file_name, os.O_RDONLY
+                                      , dir_fd = get_dir_fd( dir_fds
+                                                             , dir_path ) )
+                else:
+                    rpm_fd = os.open( path, os.O_RDONLY )
+            except os.error as e:
+                results.append( e )
+                continue
+
+            if hasattr( os, 'posix_fadvise' ):
+                try:
+                    os.posix_fadvise( rpm_fd, 0, HEADER_PREFETCH_SIZE
+                                      , os.POSIX_FADV_WILLNEED )
+                except os.error:
+                    # The hint is advisory only, so just read the file
+                    # normally.
+                    pass
+            results.append( rpm_fd )
+    finally:
+        for dir_fd in dir_fds.values():
+            os.close( dir_fd )
+
+    return results
+
+
+def get_dir_fd( dir_fds, dir_path ):
+    """ Returns a descriptor of a directory, opening it on first use.
+
+    Keyword arguments:
+    dir_fds -- The open directory descriptors, indexed by directory path. The
+    caller closes them once they are no longer needed.
+    dir_path -- The path of the directory.
+    """
+    dir_fd = dir_fds.get( dir_path )
+    if dir_fd is None:
+        dir_fd = os.open( dir_path or '.', os.O_RDONLY | os.O_DIRECTORY )
+        dir_fds[ dir_path ] = dir_fd
+
+    return dir_fd
+
+
+def read_header( path, rpm_fd ):
+    """ Reads the RPM header from an opened RPM file and closes it. This
+        function is called from the header reading threads.
+
+    Keyword arguments:
+    path -- The path of the RPM file.
+    rpm_fd -- An open file descriptor, or the os.error raised while opening
+    the file, as returned by prefetch_headers.
+
+    Returns a tuple of the RPM header, or None if it could not be read, the
+    file error message, or None if there was no error, and a flag which is
+    True if the file could be opened but is not a valid RPM file.
+    """
+    if isinstance( rpm_fd, os.error ):
+        return ( None
+                 , "Unable to open file: '%s'\nReason: %s" % ( path, rpm_fd )
+                 , False )
+
+    try:
+        return get_trans_set().hdrFromFdno( rpm_fd ), None, False
+    except os.error as e:
+        return ( None
+                 , "Unable to open file: '%s'\nReason: %s" % ( path, e )
+                 , False )
+    except rpm.error as e:
+        return ( None
+                 , "Unable to read RPM file: '%s'\nReason: %s" % ( path, e )
+                 , True )
+    finally:
+        os.close( rpm_fd )
+
+
+def get_trans_set():
+    """ Returns the RPM transaction set of the calling thread, creating it on
+        first use. Transaction sets are not shared between threads.
+    """
+    global g_thread_data
+    global g_verify_headers
+
+    rpm_trans_set = getattr( g_thread_data, 'rpm_trans_set', None )
+    if rpm_trans_set is None:
+        rpm_trans_set = rpm.TransactionSet()
+        if not g_verify_headers:
+            rpm_trans_set.setVSFlags( rpm.RPMVSF_NODSA
+                                      | rpm.RPMVSF_NODSAHEADER )
+        g_thread_data.rpm_trans_set = rpm_trans_set
+
+    return rpm_trans_set
 
 
 def process_rpm_group( rpm_data_list, run_data, num_obsolete ):
@@ -627,24 +1320,27 @@ def process_rpm_group( rpm_data_list, run_data, num_obsolete ):
                     , list_length
                     , list_length - ( num_obsolete + 1 ) )
 
-    # Sort the list of packages by version descending.
-    rpm_data_list.sort( key = cmp_to_key(cmp_RpmData_by_version) )
-    rpm_data_list.reverse()
+    # Find the num_obsolete most-recent versions to keep without sorting the
+    # whole list. nlargest is stable, like a reversed sort, so the first of
+    # several files with the same version is kept.
+    keep_end = num_obsolete + 1
+    version_key = cmp_to_key( cmp_RpmData_by_version )
+    keep_list = nlargest( keep_end, rpm_data_list, key = version_key )
+    # RpmData objects compare by identity.
+    obs_list = [ rpm_data for rpm_data in rpm_data_list
+                 if rpm_data not in keep_list ]
 
     # Display the current and obsolete versions of this package.
-    if g_logger.getEffectiveLevel() <= logging.INFO:
+    if g_logger.isEnabledFor( logging.INFO ):
         if g_display_header:
             display_pkg_info_headings()
             g_display_header = False
-        display_pkg_summary( rpm_data_list, num_obsolete )
+        obs_list.sort( key = version_key, reverse = True )
+        display_pkg_summary( keep_list + obs_list, num_obsolete )
 
-    # Mark all but the num_obsolete most-recent versions for
-    # deletion.
-    for obs_data in rpm_data_list[ ( num_obsolete + 1 ):list_length ]:
-        run_data.obs_paths.append( obs_data.path )
-        if obs_data.size < 0:
-            obs_data.size = os.path.getsize( obs_data.path )
-        run_data.total_obs_size += obs_data.size
+    # Mark all but the num_obsolete most-recent versions for deletion.
+    run_data.obs_paths.extend( obs_data.path for obs_data in obs_list )
+    run_data.total_obs_size += sum( obs_data.size for obs_data in obs_list )
 
 
 def delete_obsolete_rpms( run_data, force_del ):
@@ -661,31 +1357,67 @@ def delete_obsolete_rpms( run_data, force_del ):
     if len( run_data.obs_paths ) == 0:
         return
 
-    g_logger.info( "" )
     g_logger.info(
-        "Marked %d RPM files with a total size of %.2fM for deletion.",
+        "\nMarked %d RPM files with a total size of %.2fM for deletion.",
         len( run_data.obs_paths ), run_data.total_obs_size / 1048576.0 )
-    user_choice=''
+    user_choice = ''
     if not force_del:
-        while user_choice.lower() != 'y' and \
-                user_choice.lower() != 'n':
+        # Only the first character of the answer is checked.
+        while user_choice not in ( 'y', 'n' ):
             try:
-                user_choice = input( "\n[INFO] Are you sure you want to" + \
-                                            " permanently delete these" + \
-                                            " files y/n? " )
-            except KeyboardInterrupt as e:
+                user_choice = input( "\n[INFO] Are you sure you want to"
+                                     " permanently delete these"
+                                     " files y/n? " )
+            except ( KeyboardInterrupt, EOFError ):
                 return
+            user_choice = user_choice.strip().lower()[ :1 ]
 
     # Delete the files from the file system.
-    if force_del or user_choice.lower() == 'y':
+    if force_del or user_choice == 'y':
         g_logger.info( "Deleting RPM files..." )
-        for file_path in run_data.obs_paths:
-            g_logger.debug( "Deleting path '%s'", file_path )
-            try:
-                os.remove( file_path )
-            except os.error as e:
-                g_logger.error( "Unable to delete RPM file. %s", str( e ) )
-                sys.exit( 1 )
+        try:
+            remove_rpms( run_data.obs_paths )
+        except os.error as e:
+            g_logger.error( "Unable to delete RPM file. %s", str( e ) )
+            sys.exit( 1 )
+        g_logger.info( "Deleted %d RPM files.", len( run_data.obs_paths ) )
+
+
+def remove_rpms( rpm_paths ):
+    """ Deletes a list of RPM files, stopping at the first file which cannot
+        be deleted. Nothing is logged for each file.
+
+    Keyword arguments:
+    rpm_paths -- The paths of the RPM files to delete.
+
+    Files are removed relative to a descriptor of their directory, so the
+    kernel does not resolve the whole path of each file.
+
+    Returns nothing. Raises os.error, with the full path of the file as its
+    filename, if a file cannot be deleted.
+    """
+    # os.supports_dir_fd lists os.unlink, but not its alias os.remove.
+    remove = os.unlink
+    split = os.path.split
+    use_dir_fd = remove in os.supports_dir_fd
+    dir_fds = {}
+    # The path in use when an error is raised.
+    file_path = None
+    try:
+        # Separate loops avoid testing use_dir_fd for each file.
+        if use_dir_fd:
+            for file_path in rpm_paths:
+                dir_path, file_name = split( file_path )
+                remove( file_name, dir_fd = get_dir_fd( dir_fds, dir_path ) )
+        else:
+            for file_path in rpm_paths:
+                remove( file_path )
+    except os.error as e:
+        e.filename = file_path
+        raise
+    finally:
+        for dir_fd in dir_fds.values():
+            os.close( dir_fd )
 
 
 def display_pkg_summary( rpm_data_list, num_obsolete ):
@@ -696,83 +1428,87 @@ def display_pkg_summary( rpm_data_list, num_obsolete ):
     rpm_data_list: A list of RpmData objects sorted newest to oldest.
     num_obsolete: The number of allowed obsolete versions.
 
+    The summary is logged as a single message.
+
     Returns nothing.
     """
     global g_logger
     global g_ignore_arch
 
     if g_ignore_arch:
-        g_logger.info( rpm_data_list[ 0 ].header[ 'name' ] )
+        lines = [ rpm_data_list[ 0 ].header[ 'name' ] ]
     else:
-        g_logger.info( "%s (%s)", rpm_data_list[ 0 ].header[ 'name' ]
-                                , rpm_data_list[ 0 ].header[ 'arch' ] )
+        lines = [ "%s (%s)" % ( rpm_data_list[ 0 ].header[ 'name' ]
+                                , rpm_data_list[ 0 ].header[ 'arch' ] ) ]
 
-    for rpm_data in rpm_data_list[ 0:( num_obsolete + 1 ) ]:
-        display_pkg_info( rpm_data, "Keep" )
-    for rpm_data in rpm_data_list[ ( num_obsolete + 1 ):len( rpm_data_list ) ]:
-        display_pkg_info( rpm_data, "Delete" )
+    keep_end = num_obsolete + 1
+    for i, rpm_data in enumerate( rpm_data_list ):
+        lines.append( format_pkg_info( rpm_data
+                                       , "Keep" if i < keep_end else "Delete" ) )
+    g_logger.info( "%s", "\n".join( lines ) )
 
 
 def display_pkg_info_headings():
     """ Prints the heading row in the package information summary table. """
     global g_logger
 
-    max_width = 70
-    g_logger.info( "=" * max_width )
-    g_logger.info( "Package" )
-    g_logger.info(
-        "    Version                            Build Date     Size   Action" )
-    g_logger.info( "=" * max_width )
+    g_logger.info( "%s\nPackage\n%s\n%s"
+                   , "=" * PKG_INFO_MAX_WIDTH
+                   , "    Version                            Build Date     Size"
+                     "   Action"
+                   , "=" * PKG_INFO_MAX_WIDTH )
 
 
-def display_pkg_info( rpm_data, action ):
-    """ Logs a description of an RPM in a tabular format.
+def format_pkg_info( rpm_data, action ):
+    """ Formats a description of an RPM in a tabular format.
 
     Keyword arguments:
     rpm_data -- A RpmData containing a valid RPM header and file path.
     action -- The action that will be taken e.g. "Keep" or "Delete"
 
-    Returns nothing.
+    Returns the table row as a string.
 
     """
-    global g_logger
     global g_ignore_arch
 
-    max_width = 70
-    widths = [ 34, 11, 7, 8 ]
-    assert sum( widths ) < max_width
-    format_string = "    %" + \
-                    str( widths[ 0 ] ) + "s " + \
-                    "%" + str( widths[ 1 ] ) + "s " + \
-                    "%" + str( widths[ 2 ] ) + ".2fM " + \
-                    " %" + str( widths[ 3 ] ) + "s"
+    widths = PKG_INFO_WIDTHS
     version_string = '%s-%s' % ( rpm_data.header[ 'version' ]
                                  , rpm_data.header[ 'release' ] )
     if g_ignore_arch:
         version_string += "." + rpm_data.header[ 'arch' ]
 
-    build_date = strftime( '%d %b %Y'
-                           , gmtime( rpm_data.header[ 'buildtime' ] ) )
-    if rpm_data.size < 0:
-        rpm_data.size = os.path.getsize( rpm_data.path )
+    if rpm_data.header[ 'buildtime' ] is not None:
+        build_date = format_build_day( rpm_data.header[ 'buildtime' ] // 86400 )
+    else:
+        build_date = '-'
     size = rpm_data.size / 1048576.0
 
     # Left justify text columns.
-    if len( version_string ) < widths[ 0 ]:
-        version_string += ' ' * ( widths[ 0 ] - len( version_string ) )
-    elif len( version_string ) > widths[ 0 ]:
-        # Note: we have to indent 7 on new lines for the log prefix text.
-        version_string += "\n" + " " * ( widths[ 0 ] + 4 + 7 )
-    if len( build_date ) < widths[ 1 ]:
-        build_date += ' ' * ( widths[ 1 ] - len( build_date ) )
-    if len( action ) < widths[ 3 ]:
-        action += ' ' * ( widths[ 3 ] - len( action ) )
-
-    g_logger.info( format_string % \
-                    ( version_string
-                      , build_date
-                      , size
-                      , action ) )
+    if len( version_string ) > widths[ 0 ]:
+        version_string += PKG_INFO_VERSION_WRAP
+    else:
+        version_string = version_string.ljust( widths[ 0 ] )
+    build_date = build_date.ljust( widths[ 1 ] )
+    action = action.ljust( widths[ 3 ] )
+
+    return PKG_INFO_FORMAT % ( version_string
+                               , build_date
+                               , size
+                               , action )
+
+
+@lru_cache( maxsize = 4096 )
+def format_build_day( day ):
+    """ Formats a build date for the package information summary table.
+
+    Keyword arguments:
+    day -- The number of days since the epoch (UTC).
+
+    The results are cached, since many packages are built on the same day.
+
+    Returns the date as a string, e.g. '02 Sep 2019'.
+    """
+    return strftime( '%d %b %Y', gmtime( day * 86400 ) )
 
 
 def display_help():
@@ -864,11 +1600,19 @@ def display_help():
                              regardless of whether their architectures differ
 
         --ignore-file-errors Do not print errors relating to reading RPM package
-                             files
+                             files. The files of packages which have no
+                             obsolete versions are then not read at all.
+
+    -j, --jobs     =<int>    The number of RPM headers to read at the same
+                             time. The default value is the number of CPUs.
 
         --log-prefix =<text> Prepend text to the start of every information,
                              warning, and error message.
 
+        --no-header-cache    Do not read or update the RPM headers cached
+                             between runs in $XDG_CACHE_HOME/tidy-rpm-cache
+                             (~/.cache/tidy-rpm-cache by default).
+
     -n, --num-obsolete=<int> The maximum number of obsolete versions of a
                              package to keep. Note that the default value is 0
                              meaning that all but the newest version of a
@@ -880,6 +1624,12 @@ def display_help():
     -s, --srpm               Check for obsolete source RPMs instead of normal
                              RPMs.
 
+        --trust-filenames    Compare package versions using the filenames of
+                             RPM files which follow the
+                             name-version-release.arch.rpm template, without
+                             reading their headers. This is faster, but
+                             package epochs are not taken into account.
+
     -u, --usage              Display usage information
 
     -v, --verbose            Increase the amount of information displayed
@@ -920,8 +1670,11 @@ def display_usage():
                       {-f|--force}
                       {--ignore-arch}
                       {--ignore-file-errors}
+                      {-j|--jobs=number}
                       {--log-prefix=text}
+                      {--no-header-cache}
                       {-s|--srpm}
+                      {--trust-filenames}
                       {-u|--usage} {-h|--help} {--version}
                       {-v|--verbose} {-q|--quiet}
     """ )
@@ -938,10 +1691,10 @@ def display_disclaimer():
     """ Prints a summary of the license. """
     global g_logger
 
-    g_logger.info( "This program comes with ABSOLUTELY NO WARRANTY." )
-    g_logger.info( "This is free software, and you are welcome to" )
-    g_logger.info( "redistribute it under certain conditions." )
-    g_logger.info( "For details type 'tidy-rpm-cache.py --help'." )
+    g_logger.info( "This program comes with ABSOLUTELY NO WARRANTY.\n"
+                   "This is free software, and you are welcome to\n"
+                   "redistribute it under certain conditions.\n"
+                   "For details type 'tidy-rpm-cache.py --help'." )
 
 
 def main( argV ):
@@ -957,10 +1710,6 @@ def main( argV ):
     try:
         tidy_rpm_cache( argV )
     except Exception as e:
-        if g_logger is None:
-            logging.basicConfig()
-            g_logger = logging.getLogger()
-
         g_logger.error( "The script failed because an exception occurred." )
         g_logger.error( "For more information see the details below." )
         cla, exc, trbk = sys.exc_info()